@@ -0,0 +1,251 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for `utils/kernel.py`."""
+
+
+from jax import test_util as jtu
+from jax.api import jit
+from jax.api import pmap
+from jax.config import config as jax_config
+import jax.numpy as np
+import jax.random as random
+from jax.tree_util import tree_map
+from neural_tangents.utils.kernel import Kernel
+
+
+jax_config.parse_flags_with_absl()
+
+
+SPATIAL_SHAPES = [
+    (3,),
+    (3, 4),
+    (2, 3, 4),
+]
+
+N1 = 3
+N2 = 4
+
+
+def _get_kernel(key, spatial_shape, diagonal_batch, diagonal_spatial,
+                is_reversed=False):
+  if diagonal_spatial:
+    spatial = spatial_shape
+  else:
+    order = spatial_shape[::-1] if is_reversed else spatial_shape
+    spatial = tuple(s for s in order for _ in range(2))
+
+  batch1 = (N1,) if diagonal_batch else (N1, N1)
+  batch2 = (N2,) if diagonal_batch else (N2, N2)
+
+  keys = random.split(key, 6)
+  return Kernel(
+      nngp=random.normal(keys[0], (N1, N2) + spatial),
+      ntk=random.normal(keys[1], (N1, N2) + spatial),
+      cov1=random.normal(keys[2], batch1 + spatial),
+      cov2=random.normal(keys[3], batch2 + spatial),
+      x1_is_x2=False,
+      is_gaussian=True,
+      is_reversed=is_reversed,
+      is_input=False,
+      diagonal_batch=diagonal_batch,
+      diagonal_spatial=diagonal_spatial,
+      shape1=(N1,) + spatial_shape + (2,),
+      shape2=(N2,) + spatial_shape + (2,),
+      batch_axis=0,
+      channel_axis=-1,
+      mask1=random.bernoulli(keys[4], shape=(N1,) + spatial_shape + (1,)),
+      mask2=random.bernoulli(keys[5], shape=(N2,) + spatial_shape + (1,)))
+
+
+class KernelTest(jtu.JaxTestCase):
+
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name': '[spatial_shape={}, '
+                           'diagonal_batch={}, '
+                           'jit={}'
+                           ']'.format(spatial_shape, diagonal_batch, do_jit),
+          'spatial_shape': spatial_shape,
+          'diagonal_batch': diagonal_batch,
+          'do_jit': do_jit,
+      } for spatial_shape in SPATIAL_SHAPES
+                          for diagonal_batch in [True, False]
+                          for do_jit in [True, False]))
+  def test_reverse(self, spatial_shape, diagonal_batch, do_jit):
+    key = random.PRNGKey(1)
+    kernel = _get_kernel(key, spatial_shape, diagonal_batch, False)
+
+    ndim = len(spatial_shape)
+    source_axes = tuple(j for i in range(-ndim * 2, 0, 2) for j in (i + 1, i))
+    target_axes = tuple(range(-1, -ndim * 2 - 1, -1))
+
+    reverse = jit(Kernel.reverse) if do_jit else Kernel.reverse
+    reversed_kernel = reverse(kernel)
+    restored_kernel = reverse(reversed_kernel)
+
+    self.assertTrue(reversed_kernel.is_reversed)
+    self.assertFalse(restored_kernel.is_reversed)
+    if ndim == 1 and not do_jit:
+      # No data is moved when reversing a single spatial dimension.
+      self.assertIs(kernel.nngp, reversed_kernel.nngp)
+    for name in ('nngp', 'ntk', 'cov1', 'cov2'):
+      mat = getattr(kernel, name)
+      expected = np.moveaxis(mat, source_axes, target_axes)
+      self.assertAllClose(expected, getattr(reversed_kernel, name), True)
+      self.assertAllClose(mat, getattr(restored_kernel, name), True)
+
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name': '[diagonal_batch={}, '
+                           'diagonal_spatial={}'
+                           ']'.format(diagonal_batch, diagonal_spatial),
+          'diagonal_batch': diagonal_batch,
+          'diagonal_spatial': diagonal_spatial,
+      } for diagonal_batch in [True, False]
+                          for diagonal_spatial in [True, False]))
+  def test_transpose(self, diagonal_batch, diagonal_spatial):
+    key = random.PRNGKey(1)
+    kernel = _get_kernel(key, (2, 3, 4), diagonal_batch, diagonal_spatial)
+    transposed_kernel = kernel.transpose((2, 0, 1))
+
+    def expected(mat, batch_ndim):
+      if diagonal_spatial:
+        spatial_perm = (2, 0, 1)
+      else:
+        spatial_perm = (4, 5, 0, 1, 2, 3)
+      perm = tuple(range(batch_ndim)) + tuple(batch_ndim + a
+                                              for a in spatial_perm)
+      return np.transpose(mat, perm)
+
+    cov_batch_ndim = 1 if diagonal_batch else 2
+    self.assertAllClose(expected(kernel.cov1, cov_batch_ndim),
+                        transposed_kernel.cov1, True)
+    self.assertAllClose(expected(kernel.cov2, cov_batch_ndim),
+                        transposed_kernel.cov2, True)
+    self.assertAllClose(expected(kernel.nngp, 2), transposed_kernel.nngp, True)
+    self.assertAllClose(expected(kernel.ntk, 2), transposed_kernel.ntk, True)
+    self.assertIs(kernel, kernel.transpose())
+    self.assertIs(kernel, kernel.transpose((0, 1, 2)))
+
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name': '[spatial_shape={}, '
+                           'diagonal_batch={}, '
+                           'diagonal_spatial={}'
+                           ']'.format(spatial_shape, diagonal_batch,
+                                      diagonal_spatial),
+          'spatial_shape': spatial_shape,
+          'diagonal_batch': diagonal_batch,
+          'diagonal_spatial': diagonal_spatial,
+      } for spatial_shape in SPATIAL_SHAPES
+                          for diagonal_batch in [True, False]
+                          for diagonal_spatial in [True, False]))
+  def test_mask(self, spatial_shape, diagonal_batch, diagonal_spatial):
+    key = random.PRNGKey(1)
+    kernel = _get_kernel(key, spatial_shape, diagonal_batch, diagonal_spatial)
+    mask1, mask2 = kernel.mask1, kernel.mask2
+
+    masked_kernel = kernel.mask(mask1, mask2)
+    mask11, mask12, mask22 = kernel._get_mask_prods(mask1, mask2)
+
+    for name, mask in (('cov1', mask11),
+                       ('cov2', mask22),
+                       ('nngp', mask12),
+                       ('ntk', mask12)):
+      mat = getattr(kernel, name)
+      expected = np.where(mask, np.zeros((), mat.dtype), mat)
+      self.assertAllClose(expected, getattr(masked_kernel, name), True)
+
+    unmasked_kernel = masked_kernel.mask(None, None)
+    self.assertIsNone(unmasked_kernel.mask1)
+    self.assertIsNone(unmasked_kernel.mask2)
+    self.assertIs(masked_kernel.nngp, unmasked_kernel.nngp)
+
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name': '[n1_slice={}, n2_slice={}]'.format(n1_slice,
+                                                              n2_slice),
+          'n1_slice': n1_slice,
+          'n2_slice': n2_slice,
+      } for n1_slice in [slice(0, 1), slice(1, 3), slice(None)]
+                          for n2_slice in [slice(2, 4), slice(3, 10)]))
+  def test_slice(self, n1_slice, n2_slice):
+    key = random.PRNGKey(1)
+    kernel = _get_kernel(key, (3, 4), True, False)
+    sliced_kernel = kernel.slice(n1_slice, n2_slice)
+
+    self.assertAllClose(kernel.cov1[n1_slice], sliced_kernel.cov1, True)
+    self.assertAllClose(kernel.cov2[n2_slice], sliced_kernel.cov2, True)
+    self.assertAllClose(kernel.nngp[n1_slice, n2_slice], sliced_kernel.nngp,
+                        True)
+    self.assertAllClose(kernel.ntk[n1_slice, n2_slice], sliced_kernel.ntk,
+                        True)
+    self.assertAllClose(kernel.mask1[n1_slice], sliced_kernel.mask1, True)
+    self.assertAllClose(kernel.mask2[n2_slice], sliced_kernel.mask2, True)
+    self.assertEqual(kernel.cov1[n1_slice].shape[:1] + kernel.shape1[1:],
+                     sliced_kernel.shape1)
+    self.assertEqual(kernel.cov2[n2_slice].shape[:1] + kernel.shape2[1:],
+                     sliced_kernel.shape2)
+
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name': '[transform={}]'.format(transform),
+          'transform': transform,
+      } for transform in ['jit', 'pmap']))
+  def test_transformations(self, transform):
+    key = random.PRNGKey(1)
+    kernel = _get_kernel(key, (3, 4), True, False)
+
+    def transform_kernel(k):
+      k = k.mask(k.mask1, k.mask2).reverse().transpose((1, 0))
+      return k.slice(slice(1, 3), slice(0, 2))
+
+    expected = transform_kernel(kernel)
+    if transform == 'jit':
+      actual = jit(transform_kernel)(kernel)
+    else:
+      # `Kernel` is a pytree, so all its methods can run inside one `pmap`.
+      kernel = tree_map(lambda x: np.expand_dims(x, 0), kernel)
+      actual = tree_map(lambda x: x[0], pmap(transform_kernel)(kernel))
+
+    self.assertEqual(expected.is_reversed, actual.is_reversed)
+    self.assertEqual(expected.shape1, actual.shape1)
+    self.assertEqual(expected.shape2, actual.shape2)
+    for name in ('nngp', 'ntk', 'cov1', 'cov2', 'mask1', 'mask2'):
+      self.assertAllClose(getattr(expected, name), getattr(actual, name), True)
+
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name': '[dtype={}]'.format(dtype.__name__),
+          'dtype': dtype,
+      } for dtype in [np.bfloat16, np.float16, np.float32]))
+  def test_dtype_is_preserved(self, dtype):
+    key = random.PRNGKey(1)
+    kernel = _get_kernel(key, (3, 4), True, False)
+    kernel = kernel.replace(**{name: getattr(kernel, name).astype(dtype)
+                               for name in ('nngp', 'ntk', 'cov1', 'cov2')})
+
+    transformed = [
+        kernel.reverse(),
+        kernel.transpose((1, 0)),
+        kernel.mask(kernel.mask1, kernel.mask2),
+        kernel.slice(slice(0, 2), slice(1, 3))
+    ]
+    for k in transformed:
+      for name in ('nngp', 'ntk', 'cov1', 'cov2'):
+        self.assertEqual(np.dtype(dtype), getattr(k, name).dtype)
+
+
+if __name__ == '__main__':
+  jtu.absltest.main()
@@ -255,8 +255,10 @@ def _serial(kernel_fn, batch_size, store_on_device=True):
                                                                  batch_size,
                                                                  device_count)
 
-    n1s = np.arange(0, n1, n1_batch_size)
-    n2s = np.arange(0, n2, n2_batch_size)
+    # Python integers (rather than device arrays) keep slice bounds on the host
+    # and avoid a device-to-host transfer when slicing every batch.
+    n1s = range(0, n1, n1_batch_size)
+    n2s = range(0, n2, n2_batch_size)
 
     def row_fn(_, n1):
       return _, _scan(col_fn, n1, n2s, store_on_device)[1]
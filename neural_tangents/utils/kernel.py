@@ -16,11 +16,14 @@
 """The `Kernel` class containing NTK and NNGP `np.ndarray`s as fields."""
 
 
+import functools
 import operator as op
+from jax import lax
+from jax.api import jit
 import jax.numpy as np
 from neural_tangents.utils import dataclasses
 from neural_tangents.utils import utils
-from typing import Tuple, Optional, Union
+from typing import Tuple, Optional
 
 
 @dataclasses.dataclass
@@ -115,19 +118,43 @@ class Kernel:
   mask2: Optional[np.ndarray]
 
   def slice(self, n1_slice: slice, n2_slice: slice) -> 'Kernel':
-    cov1 = self.cov1[n1_slice]
-    cov2 = self.cov1[n2_slice] if self.cov2 is None else self.cov2[n2_slice]
+    """Slice the `Kernel` along the first and second batch dimensions.
 
-    mask1 = None if self.mask1 is None else self.mask1[n1_slice]
-    mask2 = None if self.mask2 is None else self.mask2[n2_slice]
+    All covariance matrices and masks are sliced within a single jitted
+    computation. Slice starts are passed to it as dynamic arguments, so slices
+    of equal sizes (e.g. batches in `nt.batch`) share one compiled function.
+
+    Args:
+      n1_slice: a contiguous `slice` of the first batch of inputs.
+      n2_slice: a contiguous `slice` of the second batch of inputs.
+
+    Returns:
+      A `Kernel` object restricted to the given batches of inputs.
+    """
+    n1_start, n1_stop, n1_step = n1_slice.indices(self.nngp.shape[0])
+    n2_start, n2_stop, n2_step = n2_slice.indices(self.nngp.shape[1])
+    if n1_step != 1 or n2_step != 1:
+      raise NotImplementedError(
+          f'Only contiguous slices are supported, got steps '
+          f'{n1_step} and {n2_step}.')
+
+    # Batch sizes are known statically from the slices.
+    n1, n2 = n1_stop - n1_start, n2_stop - n2_start
+
+    cov2 = self.cov1 if self.cov2 is None else self.cov2
+    cov1, nngp, cov2, ntk, mask1, mask2 = _slice(
+        (self.cov1, self.nngp, cov2, self.ntk, self.mask1, self.mask2),
+        (n1_start, n2_start),
+        n1,
+        n2)
 
     return self.replace(
         cov1=cov1,
-        nngp=self.nngp[n1_slice, n2_slice],
+        nngp=nngp,
         cov2=cov2,
-        ntk=self.ntk[n1_slice, n2_slice],
-        shape1=(cov1.shape[0],) + self.shape1[1:],
-        shape2=(cov2.shape[0],) + self.shape2[1:],
+        ntk=ntk,
+        shape1=(n1,) + self.shape1[1:],
+        shape2=(n2,) + self.shape2[1:],
         mask1=mask1,
         mask2=mask2)
 
@@ -144,21 +171,14 @@ class Kernel:
     # Number of spatial dimensions = total - (1 for batch + 1 for channels)
     ndim = len(self.shape1) - 2
 
-    # ndim == 3: (-5, -6, -3, -4, -1, -2)
-    source_axes = tuple(j for i in range(-ndim * 2, 0, 2) for j in (i + 1, i))
-
-    # ndim == 3: (-1, -2, -3, -4, -5, -6)
-    target_axes = tuple(range(-1, -ndim * 2 - 1, -1))
+    # With at most one spatial dimension, reversal only changes the metadata.
+    if ndim < 2:
+      return self.replace(is_reversed=not self.is_reversed)
 
-    def reverse(mat):
-      if utils.is_array(mat):
-        return np.moveaxis(mat, source_axes, target_axes)
-      return mat
-
-    cov1, nngp, cov2, ntk = map(reverse, (self.cov1,
-                                          self.nngp,
-                                          self.cov2,
-                                          self.ntk))
+    cov1, nngp, cov2, ntk = _reverse((self.cov1,
+                                      self.nngp,
+                                      self.cov2,
+                                      self.ntk), ndim)
     return self.replace(cov1=cov1, nngp=nngp, cov2=cov2, ntk=ntk,
                         is_reversed=not self.is_reversed)
 
@@ -176,40 +196,34 @@ class Kernel:
     """
     if axes is None:
       axes = tuple(range(len(self.shape1) - 2))
+    axes = tuple(axes)
 
-    def permute(mat: Union[None, float, np.ndarray],
-        batch_ndim: int) -> Union[None, float, np.ndarray]:
-      if utils.is_array(mat):
-        _axes = tuple(batch_ndim + a for a in axes)
-        if not self.diagonal_spatial:
-          _axes = tuple(j for a in _axes
-                        for j in (2 * a - batch_ndim,
-                                  2 * a - batch_ndim + 1))
-        _axes = tuple(range(batch_ndim)) + _axes
-        return np.transpose(mat, _axes)
-      return mat
+    # Layers often request the identity permutation: skip dispatching it.
+    if axes == tuple(range(len(axes))):
+      return self
 
-    cov1 = permute(self.cov1, 1 if self.diagonal_batch else 2)
-    cov2 = permute(self.cov2, 1 if self.diagonal_batch else 2)
-    nngp = permute(self.nngp, 2)
-    ntk = permute(self.ntk, 2)
+    cov1, nngp, cov2, ntk = _transpose(
+        (self.cov1, self.nngp, self.cov2, self.ntk),
+        axes,
+        self.diagonal_batch,
+        self.diagonal_spatial)
     return self.replace(cov1=cov1, nngp=nngp, cov2=cov2, ntk=ntk)
 
   def mask(self,
            mask1: Optional[np.ndarray],
            mask2: Optional[np.ndarray]) -> 'Kernel':
     """Mask all covariance matrices according to `mask1`, `mask2`"""
-    mask11, mask12, mask22 = self._get_mask_prods(mask1, mask2)
-
-    def mask_mat(mat, mask):
-      if not utils.is_array(mat) or mask is None:
-        return mat
-      return np.where(mask, np.zeros((), mat.dtype), mat)
-
-    cov1 = mask_mat(self.cov1, mask11)
-    cov2 = mask_mat(self.cov2, mask22)
-    nngp = mask_mat(self.nngp, mask12)
-    ntk = mask_mat(self.ntk, mask12)
+    if mask1 is None and mask2 is None:
+      return self.replace(mask1=mask1, mask2=mask2)
+
+    cov1, nngp, cov2, ntk = _mask((self.cov1, self.nngp, self.cov2, self.ntk),
+                                  mask1,
+                                  None if mask2 is mask1 else mask2,
+                                  self.batch_axis,
+                                  self.channel_axis,
+                                  self.is_reversed,
+                                  self.diagonal_batch,
+                                  self.diagonal_spatial)
 
     return self.replace(cov1=cov1, nngp=nngp, cov2=cov2, ntk=ntk,
                         mask1=mask1, mask2=mask2)
@@ -221,35 +235,247 @@ class Kernel:
              Optional[np.ndarray],
              Optional[np.ndarray]]:
     """Gets outer products of `mask1, mask1`, `mask1, mask2`, `mask2, mask2`."""
-    def get_mask_prod(m1, m2, batch_ndim):
-      if m1 is None and m2 is None:
-        return None
-
-      def reshape(m):
-        if m is not None:
-          if m.shape[self.channel_axis] != 1:
-            raise NotImplementedError(
-                f'Different channel-wise masks are not supported for '
-                f'infinite-width layers now (got `mask.shape == {m.shape}). '
-                f'Please describe your use case at '
-                f'https://github.com/google/neural-tangents/issues/new')
-
-          m = np.squeeze(np.moveaxis(m, (self.batch_axis, self.channel_axis),
-                                     (0, -1)), -1)
-          if self.is_reversed:
-            m = np.moveaxis(m, range(1, m.ndim), range(m.ndim - 1, 0, -1))
-        return m
-
-      m1, m2 = reshape(m1), reshape(m2)
-
-      start_axis = 2 - batch_ndim
-      end_axis = 1 if self.diagonal_spatial else m1.ndim
-
-      mask = utils.outer_prod(m1, m2, start_axis, end_axis, op.or_)
-      return mask
-
-    mask11 = get_mask_prod(mask1, mask1, 1 if self.diagonal_batch else 2)
-    mask22 = (get_mask_prod(mask2, mask2, 1 if self.diagonal_batch else 2)
-              if mask2 is not None else mask11)
-    mask12 = get_mask_prod(mask1, mask2, 2)
+    is_symmetric = mask2 is None or mask2 is mask1
+    mask11, mask12, mask22 = _get_mask_prods(
+        mask1,
+        None if is_symmetric else mask2,
+        self.batch_axis,
+        self.channel_axis,
+        self.is_reversed,
+        self.diagonal_batch,
+        self.diagonal_spatial)
+
+    # Symmetric products are computed once, but `jit` returns them as distinct
+    # arrays. Restore the sharing to let callers reuse work on them.
+    if is_symmetric:
+      mask22 = mask11
+      if not self.diagonal_batch:
+        mask12 = mask11
     return mask11, mask12, mask22
+
+
+# INTERNAL UTILITIES
+
+
+def _jit_arrays(*static_argnums: int):
+  """Like `jit`, but only passes arrays from the first argument `mats` to it.
+
+  `Kernel` covariance matrices can be absent (`None`) or scalars (e.g. `ntk`
+  before the first layer). These are replaced with `None` before the call to
+  the jitted function and returned as is after. This way the jitted function
+  only handles `np.ndarray` or `None` entries and is compiled once per set of
+  present arrays, rather than branching on them or receiving scalars that
+  `jit` would turn into device arrays.
+  """
+  def jit_arrays(f):
+    f_jit = jit(f, static_argnums=static_argnums)
+
+    @functools.wraps(f)
+    def f_arrays(mats, *args):
+      is_array = tuple(utils.is_array(mat) for mat in mats)
+      outs = f_jit(tuple(mat if a else None for mat, a in zip(mats, is_array)),
+                   *args)
+      return tuple(out if a else mat
+                   for mat, out, a in zip(mats, outs, is_array))
+
+    return f_arrays
+
+  return jit_arrays
+
+
+@_jit_arrays(1)
+def _reverse(mats, ndim):
+  """Reverses the order of `ndim` trailing pairs of spatial axes in `mats`.
+
+  All covariance matrices are transposed within a single jitted computation,
+  so a call to `Kernel.reverse` costs one dispatch instead of four.
+  """
+  return _map_arrays(
+      lambda mat: np.transpose(mat, _get_reverse_perm(mat.ndim, ndim)), mats)
+
+
+@_jit_arrays(2, 3)
+def _slice(mats, starts, n1, n2):
+  """Slices `n1` and `n2` entries from `starts` along the batch axes of `mats`.
+
+  `mats` are `(cov1, nngp, cov2, ntk, mask1, mask2)`, where `cov1` and `mask1`
+  are sliced along the first axis with the first batch slice, `cov2` and
+  `mask2` - along the first axis with the second batch slice, and `nngp` and
+  `ntk` - along the first two axes with both batch slices.
+  """
+  n1_start, n2_start = starts
+
+  def slice_mats(mats, starts, sizes):
+    # One `dynamic_slice` per array over all sliced axes, with start indices
+    # shared by both arrays of a pair.
+    def slice_mat(mat):
+      n_rest = mat.ndim - len(starts)
+      return lax.dynamic_slice(mat,
+                               starts + (0,) * n_rest,
+                               sizes + mat.shape[len(sizes):])
+    return _map_arrays(slice_mat, mats)
+
+  cov1, nngp, cov2, ntk, mask1, mask2 = mats
+  cov1, mask1 = slice_mats((cov1, mask1), (n1_start,), (n1,))
+  cov2, mask2 = slice_mats((cov2, mask2), (n2_start,), (n2,))
+  nngp, ntk = slice_mats((nngp, ntk), (n1_start, n2_start), (n1, n2))
+  return cov1, nngp, cov2, ntk, mask1, mask2
+
+
+@_jit_arrays(3, 4, 5, 6, 7)
+def _mask(mats, mask1, mask2, batch_axis, channel_axis, is_reversed,
+          diagonal_batch, diagonal_spatial):
+  """Zeroes-out covariances between entries of which at least one is masked.
+
+  `mats` are `(cov1, nngp, cov2, ntk)`. Instead of materializing outer
+  products of masks (boolean arrays as large as the covariances themselves),
+  each covariance is multiplied by the broadcasted visibilities of its two
+  inputs, which XLA fuses into a single elementwise pass over the covariance.
+  """
+  def get_visible(m):
+    if m is None:
+      return None
+    return np.logical_not(
+        _reshape_mask(m, batch_axis, channel_axis, is_reversed))
+
+  visible1 = get_visible(mask1)
+  visible2 = visible1 if mask2 is None else get_visible(mask2)
+
+  def mask_mat(mat, v1, v2, batch_ndim):
+    if mat is None:
+      return mat
+
+    start_axis = 2 - batch_ndim
+    for v, v_first in ((v1, True), (v2, False)):
+      if v is not None:
+        end_axis = 1 if diagonal_spatial else v.ndim
+        v = utils.interleave_ones(v, start_axis, end_axis, v_first)
+        mat = mat * v.astype(mat.dtype)
+    return mat
+
+  cov_batch_ndim = 1 if diagonal_batch else 2
+  cov1, nngp, cov2, ntk = mats
+  return (mask_mat(cov1, visible1, visible1, cov_batch_ndim),
+          mask_mat(nngp, visible1, visible2, 2),
+          mask_mat(cov2, visible2, visible2, cov_batch_ndim),
+          mask_mat(ntk, visible1, visible2, 2))
+
+
+@functools.partial(jit, static_argnums=(2, 3, 4, 5, 6))
+def _get_mask_prods(
+    mask1: Optional[np.ndarray],
+    mask2: Optional[np.ndarray],
+    batch_axis: int,
+    channel_axis: int,
+    is_reversed: bool,
+    diagonal_batch: bool,
+    diagonal_spatial: bool
+) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray]]:
+  """Gets outer products of `mask1, mask1`, `mask1, mask2`, `mask2, mask2`.
+
+  Jitted with all `Kernel` layout attributes static, so that the reshaping and
+  outer products of masks compile into a single computation per layout.
+  """
+  def reshape(m):
+    if m is not None:
+      m = _reshape_mask(m, batch_axis, channel_axis, is_reversed)
+    return m
+
+  def get_mask_prod(m1, m2, batch_ndim):
+    if m1 is None and m2 is None:
+      return None
+
+    start_axis = 2 - batch_ndim
+    end_axis = 1 if diagonal_spatial else m1.ndim
+
+    mask = utils.outer_prod(m1, m2, start_axis, end_axis, op.or_)
+    return mask
+
+  # Reshape each mask only once and reuse it in all outer products.
+  m1, m2 = reshape(mask1), reshape(mask2)
+
+  batch_ndim = 1 if diagonal_batch else 2
+  mask11 = get_mask_prod(m1, m1, batch_ndim)
+
+  if mask2 is None:
+    # All products are of `mask1` with itself, and `mask12` only differs from
+    # `mask11` if the latter is batch-diagonal.
+    mask22 = mask11
+    mask12 = get_mask_prod(m1, m1, 2) if diagonal_batch else mask11
+  else:
+    mask22 = get_mask_prod(m2, m2, batch_ndim)
+    mask12 = get_mask_prod(m1, m2, 2)
+  return mask11, mask12, mask22
+
+
+def _reshape_mask(mask: np.ndarray,
+                  batch_axis: int,
+                  channel_axis: int,
+                  is_reversed: bool) -> np.ndarray:
+  """Moves the batch axis first and squeezes the channel axis of `mask`."""
+  if mask.shape[channel_axis] != 1:
+    raise NotImplementedError(
+        f'Different channel-wise masks are not supported for '
+        f'infinite-width layers now (got `mask.shape == {mask.shape}). '
+        f'Please describe your use case at '
+        f'https://github.com/google/neural-tangents/issues/new')
+
+  mask = np.squeeze(np.moveaxis(mask, (batch_axis, channel_axis), (0, -1)),
+                    -1)
+  if is_reversed:
+    mask = np.moveaxis(mask, range(1, mask.ndim), range(mask.ndim - 1, 0, -1))
+  return mask
+
+
+@functools.lru_cache(maxsize=None)
+def _get_reverse_perm(mat_ndim: int, ndim: int) -> Tuple[int, ...]:
+  """Returns the permutation of covariance axes for `Kernel.reverse`."""
+  batch_ndim = mat_ndim - 2 * ndim
+  # ndim == 3: (4, 5, 2, 3, 0, 1), offset by the number of leading axes.
+  spatial_perm = tuple(j for i in range(ndim * 2 - 2, -1, -2)
+                       for j in (i, i + 1))
+  return tuple(range(batch_ndim)) + tuple(batch_ndim + a for a in spatial_perm)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_transpose_perm(axes: Tuple[int, ...],
+                        batch_ndim: int,
+                        diagonal_spatial: bool) -> Tuple[int, ...]:
+  """Returns the permutation of covariance axes for `Kernel.transpose`."""
+  _axes = tuple(batch_ndim + a for a in axes)
+  if not diagonal_spatial:
+    _axes = tuple(j for a in _axes
+                  for j in (2 * a - batch_ndim,
+                            2 * a - batch_ndim + 1))
+  return tuple(range(batch_ndim)) + _axes
+
+
+@_jit_arrays(1, 2, 3)
+def _transpose(mats, axes, diagonal_batch, diagonal_spatial):
+  """Permutes spatial axes of `mats == (cov1, nngp, cov2, ntk)` by `axes`.
+
+  `cov1` and `cov2`, as well as `nngp` and `ntk`, share the same layout, so
+  only two distinct permutations are applied, within a single computation.
+  """
+  cov1, nngp, cov2, ntk = mats
+
+  cov_perm = _get_transpose_perm(axes, 1 if diagonal_batch else 2,
+                                 diagonal_spatial)
+  cov1, cov2 = _map_arrays(lambda mat: np.transpose(mat, cov_perm),
+                           (cov1, cov2))
+
+  nngp_perm = _get_transpose_perm(axes, 2, diagonal_spatial)
+  nngp, ntk = _map_arrays(lambda mat: np.transpose(mat, nngp_perm),
+                          (nngp, ntk))
+  return cov1, nngp, cov2, ntk
+
+
+def _map_arrays(fn, mats):
+  """Applies `fn` to each array in `mats`, passing through `None`s.
+
+  `Kernel` covariance matrices come in pairs with the same layout (`cov1` and
+  `cov2`, `nngp` and `ntk`), either of which can be absent. Transforming a
+  pair at once lets it share one permutation / slice computation and a single
+  dispatch.
+  """
+  return tuple(None if mat is None else fn(mat) for mat in mats)
@@ -278,6 +278,23 @@ def zip_flat(x, y):
 
 
 def interleave_ones(x, start_axis, end_axis, x_first):
+  """Interleave ones between axes from `start_axis` until `end_axis`.
+
+  Changes the shape as follows:
+    If `x_first == True`:
+    `[..., X, Y, Z, ...] -> [..., X, 1, Y, 1, Z, 1, ...]`
+    If `x_first == False`:
+    `[..., X, Y, Z, ...] -> [..., 1, X, 1, Y, 1, Z, ...]`
+
+  Args:
+    x: `np.ndarray`.
+    start_axis: `int`, number of axis from which to interleave.
+    end_axis: `int`, number of axis until which to interleave.
+    x_first: `bool`, whether the axes of `x` come before the inserted ones.
+
+  Returns:
+    A reshaped `np.ndarray`. No data is moved.
+  """
   x_axes = x.shape[start_axis:end_axis]
   ones = (1,) * (end_axis - start_axis)
   shape = x.shape[:start_axis]
@@ -290,6 +307,25 @@ def interleave_ones(x, start_axis, end_axis, x_first):
 
 
 def outer_prod(x, y, start_axis, end_axis, prod_op):
+  """Outer product of `x` and `y` along axes from `start_axis` to `end_axis`.
+
+  The output has the shape of `x` with each axis between `start_axis` and
+  `end_axis` replaced by a pair of axes (from `x` and `y` respectively), e.g.
+  `[..., X, Y, ...] -> [..., X, X, Y, Y, ...]`. It is computed as a single
+  broadcasted `prod_op` of reshaped `x` and `y`, so the traced graph size does
+  not depend on the number of axes.
+
+  Args:
+    x: `np.ndarray`.
+    y: `np.ndarray` of the same number of dimensions as `x`, or `None` to use
+      `x` instead.
+    start_axis: `int`, number of axis from which to take the outer product.
+    end_axis: `int`, number of axis until which to take the outer product.
+    prod_op: a binary broadcasting elementwise operation, e.g. `op.mul`.
+
+  Returns:
+    A `np.ndarray` with the outer product of `x` and `y`.
+  """
   if y is None:
     y = x
   x = interleave_ones(x, start_axis, end_axis, True)
@@ -345,6 +381,9 @@ def get_masked_array(x: _array_or_list,
     raise TypeError(x, type(x))
 
   if mask is not None:
-    x = np.where(mask, np.zeros((), x.dtype), x)
+    # A host scalar of `x.dtype` avoids allocating a zero array on device.
+    # `np.where` (rather than multiplying by the mask) is required here, since
+    # masked entries can be `np.nan` or `np.inf`.
+    x = np.where(mask, x.dtype.type(0), x)
 
   return MaskedArray(x, mask)